@@ -1,8 +1,13 @@
 import streamlit as st
 import pandas as pd
 import os
+import io
+import functools
+import json
 import random
 import time
+import cProfile
+import pstats
 from datetime import datetime
 from PIL import Image
 
@@ -20,6 +25,13 @@ try:
 except Exception:
     _HAS_MPL = False
 
+# pyinstrument לדגימה במצב פיתוח (אופציונלי)
+try:
+    from pyinstrument import Profiler as _PyInstrumentProfiler
+    _HAS_PYINSTRUMENT = True
+except Exception:
+    _HAS_PYINSTRUMENT = False
+
 ###############################################
 # הגדרות בסיס
 ###############################################
@@ -28,7 +40,212 @@ st.set_page_config(layout="wide", page_title="ניסוי זיכרון חזותי
 # האם להציג את תגית הקבוצה? (מוסתר לפי הדרישה)
 SHOW_GROUP_BADGE = False
 
-st.markdown("""
+###############################################
+# פרופיילינג ריצות (מצב פיתוח בלבד)
+###############################################
+# MEMORY_EXP_PROFILING=0 מבטל את המנגנון לחלוטין, גם במצב פיתוח
+PROFILING_ALLOWED = os.environ.get("MEMORY_EXP_PROFILING", "1") != "0"
+PERF_HISTORY_LEN = 50
+PERF_PROFILE_TOP = 25
+PERF_SAMPLERS = ["ללא", "cProfile"] + (["pyinstrument"] if _HAS_PYINSTRUMENT else [])
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _NullPerf:
+    """מקליט ריק — כשמצב פיתוח כבוי אין מדידה בכלל."""
+    enabled = False
+    def span(self, name):
+        return _NULL_SPAN
+    def note(self, key, value):
+        pass
+    def finish(self):
+        pass
+
+class _Span:
+    __slots__ = ("rec", "name", "meta", "t0")
+
+    def __init__(self, rec, name):
+        self.rec, self.name, self.meta = rec, name, {}
+
+    def __enter__(self):
+        self.rec._stack.append(self)
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.perf_counter_ns()
+        self.rec._stack.pop()
+        self.rec.record["spans"].append({
+            "name": self.name,
+            "depth": len(self.rec._stack),
+            "start_ms": (self.t0 - self.rec.t0) / 1e6,
+            "ms": (t1 - self.t0) / 1e6,
+            **self.meta,
+        })
+        self.rec.record["end_ns"] = t1
+        return False
+
+class _PerfRecorder:
+    """מודד זמני שלבים (perf_counter_ns) לריצה אחת של הסקריפט, עם דגימת פרופיילר אופציונלית."""
+    enabled = True
+
+    def __init__(self):
+        ss = st.session_state
+        if "_perf_open" in ss:
+            # הריצה הקודמת נקטעה (st.stop / חריגה) — נסגור אותה עד ה-span האחרון שנמדד
+            _close_perf_record(ss.pop("_perf_open"), _stop_sampler())
+        self._stack = []
+        self.t0 = time.perf_counter_ns()
+        self.record = {
+            "run": ss.get("_perf_runs", 0) + 1,
+            "timestamp": datetime.now().isoformat(),
+            "stage": ss.get("stage"),
+            "group": ss.get("group"),
+            "t0_ns": self.t0,
+            "end_ns": self.t0,
+            "spans": [],
+        }
+        ss["_perf_runs"] = self.record["run"]
+        ss["_perf_open"] = self.record
+        _start_sampler(ss.get("perf_sampler", PERF_SAMPLERS[0]))
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def note(self, key, value):
+        """מצמיד מידע (למשל cache hit/miss, backend) ל-span הפנימי הפתוח."""
+        if self._stack:
+            self._stack[-1].meta[key] = value
+
+    def finish(self):
+        ss = st.session_state
+        if ss.get("_perf_open") is not self.record:
+            return
+        del ss["_perf_open"]
+        self.record["end_ns"] = time.perf_counter_ns()
+        _close_perf_record(self.record, _stop_sampler())
+
+def _start_sampler(kind):
+    try:
+        if kind == "cProfile":
+            prof = cProfile.Profile()
+            prof.enable()
+        elif kind == "pyinstrument" and _HAS_PYINSTRUMENT:
+            prof = _PyInstrumentProfiler()
+            prof.start()
+        else:
+            return
+    except Exception:
+        return  # פרופיילר אחר כבר פעיל
+    st.session_state["_perf_profiler"] = (kind, prof)
+
+def _stop_sampler():
+    entry = st.session_state.pop("_perf_profiler", None)
+    if entry is None:
+        return None
+    kind, prof = entry
+    try:
+        if kind == "cProfile":
+            prof.disable()
+            buf = io.StringIO()
+            pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(PERF_PROFILE_TOP)
+            return buf.getvalue()
+        prof.stop()
+        return prof.output_text()
+    except Exception as e:
+        return f"שגיאה בדגימה: {e}"
+
+def _close_perf_record(record, profile_text):
+    ss = st.session_state
+    record["total_ms"] = (record.pop("end_ns") - record.pop("t0_ns")) / 1e6
+    top_level = sum(sp["ms"] for sp in record["spans"] if sp["depth"] == 0)
+    record["other_ms"] = max(0.0, record["total_ms"] - top_level)
+    if profile_text:
+        record["profile"] = profile_text
+    history = ss.setdefault("_perf_history", [])
+    history.append(record)
+    del history[:-PERF_HISTORY_LEN]
+    if ss.get("perf_json_log"):
+        _append_perf_json(record)
+
+def _append_perf_json(record):
+    results_dir = "experiment_results"
+    session = st.session_state.setdefault("_perf_session", datetime.now().strftime("%Y%m%d_%H%M%S"))
+    try:
+        os.makedirs(results_dir, exist_ok=True)
+        with open(f"{results_dir}/perf_{session}.jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        st.sidebar.warning(f"שגיאה בכתיבת לוג הפרופיילינג: {e}")
+
+# בריצה שאינה במצב פיתוח _perf הוא מקליט ריק ו-traced מחזיר את הפונקציה המקורית
+if PROFILING_ALLOWED and st.session_state.get("dev_mode", False):
+    _perf = _PerfRecorder()
+else:
+    # ריצה קודמת במצב פיתוח שנקטעה (למשל בלחיצה על "מצב פיתוח") — עוצרים את הדוגם וסוגרים אותה
+    if "_perf_open" in st.session_state:
+        _close_perf_record(st.session_state.pop("_perf_open"), _stop_sampler())
+    elif "_perf_profiler" in st.session_state:
+        _stop_sampler()
+    _perf = _NullPerf()
+
+def traced(name, cached=False):
+    """עוטף פונקציה ב-span רק כשהפרופיילינג פעיל בריצה הנוכחית."""
+    def deco(fn):
+        if not _perf.enabled:
+            return fn
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _perf.span(name) as sp:
+                if cached:
+                    sp.meta["cache"] = "hit"  # גוף הפונקציה רץ רק ב-miss ודורס את הערך
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def rerun():
+    """st.rerun() שסוגר קודם את מדידת הריצה הנוכחית."""
+    _perf.finish()
+    st.rerun()
+
+def _perf_breakdown(records):
+    """ממוצע זמן לריצה וחלק מהזמן הכולל לכל שלב, על פני רשימת ריצות."""
+    totals = {}
+    for rec in records:
+        for sp in rec["spans"]:
+            label = sp["name"] + "".join(f" [{sp[k]}]" for k in ("cache", "backend") if k in sp)
+            totals[label] = totals.get(label, 0.0) + sp["ms"]
+        totals["(אחר)"] = totals.get("(אחר)", 0.0) + rec["other_ms"]
+    grand_total = sum(rec["total_ms"] for rec in records) or 1.0
+    rows = [{"שלב": k, "ms": round(v / len(records), 2), "%": round(100 * v / grand_total, 1)}
+            for k, v in totals.items()]
+    return pd.DataFrame(rows).sort_values("ms", ascending=False).reset_index(drop=True)
+
+def render_perf_panel():
+    """פאנל צד: פירוק שלבים של הריצה הקודמת + ממוצע על הריצות האחרונות."""
+    with st.sidebar.expander("פרופיילינג ריצות", expanded=False):
+        st.checkbox("רישום ל-JSON (experiment_results)", key="perf_json_log", value=False)
+        st.selectbox("דגימת פרופיילר", PERF_SAMPLERS, key="perf_sampler")
+        history = st.session_state.get("_perf_history", [])
+        if not history:
+            st.caption("אין עדיין ריצות מדודות.")
+            return
+        last = history[-1]
+        st.markdown(f"**ריצה #{last['run']}** ({last['stage']}) — {last['total_ms']:.1f}ms")
+        st.dataframe(_perf_breakdown([last]), use_container_width=True, hide_index=True)
+        if len(history) > 1:
+            st.caption(f"ממוצע על {len(history)} הריצות האחרונות")
+            st.dataframe(_perf_breakdown(history), use_container_width=True, hide_index=True)
+        if last.get("profile"):
+            st.code(last["profile"], language=None)
+
+_APP_CSS = """
 <style>
   body {direction: rtl; text-align: right;}
   .rtl {direction: rtl; text-align: right;}
@@ -50,7 +267,10 @@ st.markdown("""
   .progress-label{ text-align:right; direction:rtl; font-size:14px; margin:6px 0 4px; }
   .title-above-chart{ text-align:center; direction:rtl; margin:10px 0 6px; font-size:26px; font-weight:800; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+with _perf.span("inject_css"):
+    st.markdown(_APP_CSS, unsafe_allow_html=True)
 
 ###############################################
 # פונקציות עזר להצגה
@@ -90,15 +310,18 @@ def render_chart_title(row: pd.Series):
         st.markdown(f"<div class='title-above-chart'>{t}</div>", unsafe_allow_html=True)
 
 def tick_and_rerun(delay: float = 1.0):
-    time.sleep(max(0.2, float(delay)))
-    st.rerun()
+    with _perf.span("tick_and_rerun.sleep"):
+        time.sleep(max(0.2, float(delay)))
+    rerun()
 
 ###############################################
 # טעינת נתוני הניסוי ונתוני הגרפים
 ###############################################
 
+@traced("load_memory_test", cached=True)
 @st.cache_data()
 def load_memory_test():
+    _perf.note("cache", "miss")
     try:
         df = pd.read_csv("MemoryTest.csv", encoding='utf-8-sig')
         df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
@@ -121,8 +344,10 @@ def load_memory_test():
         st.error(f"שגיאה בטעינת הקובץ MemoryTest.csv: {e}")
         return pd.DataFrame()
 
+@traced("load_graph_db", cached=True)
 @st.cache_data()
 def load_graph_db():
+    _perf.note("cache", "miss")
     try:
         db = pd.read_csv("graph_DB.csv", encoding='utf-8-sig')
         db = db.loc[:, ~db.columns.str.contains('^Unnamed')]
@@ -153,6 +378,7 @@ def current_graph_id(row_dict):
                 pass
     return None
 
+@traced("get_graph_slice")
 def get_graph_slice(graph_db: pd.DataFrame, graph_id: int):
     if graph_db.empty or graph_id is None:
         return pd.DataFrame()
@@ -160,6 +386,7 @@ def get_graph_slice(graph_db: pd.DataFrame, graph_id: int):
         return pd.DataFrame()
     return graph_db[graph_db['ID'] == graph_id].copy()
 
+@traced("draw_bar_chart")
 def draw_bar_chart(sub: pd.DataFrame, title: str | None = None, height: int = 380):
     if sub.empty:
         st.warning("לא נמצאו נתונים לגרף המבוקש בקובץ graph_DB.csv")
@@ -183,6 +410,7 @@ def draw_bar_chart(sub: pd.DataFrame, title: str | None = None, height: int = 38
     has_b = 'ValuesB' in sub.columns and sub['ValuesB'].notna().any()
 
     if _HAS_ALT:
+        _perf.note("backend", "altair")
         x_axis = alt.Axis(labelAngle=0, labelPadding=6, title=None)
         y_axis = alt.Axis(grid=True, tickCount=6, title=None)
 
@@ -223,6 +451,7 @@ def draw_bar_chart(sub: pd.DataFrame, title: str | None = None, height: int = 38
         return
 
     if _HAS_MPL:
+        _perf.note("backend", "matplotlib")
         labels = sub['Labels'].astype(str).tolist() if 'Labels' in sub.columns else [str(i) for i in range(len(sub))]
         vals_a = sub['ValuesA'].fillna(0).tolist() if 'ValuesA' in sub.columns else [0]*len(labels)
         x = range(len(labels))
@@ -259,6 +488,7 @@ def draw_bar_chart(sub: pd.DataFrame, title: str | None = None, height: int = 38
         st.pyplot(fig, clear_figure=True)
         return
 
+    _perf.note("backend", "st.bar_chart")
     if has_b:
         data = sub[['Labels','ValuesA','ValuesB']].copy()
         data.rename(columns={'ValuesA': name_a, 'ValuesB': name_b}, inplace=True)
@@ -274,7 +504,9 @@ def draw_bar_chart(sub: pd.DataFrame, title: str | None = None, height: int = 38
 is_dev_mode = st.sidebar.checkbox("מצב פיתוח", key="dev_mode", value=False)
 if is_dev_mode and st.sidebar.button("רענון נתונים (ניקוי קאש)"):
     st.cache_data.clear()
-    st.rerun()
+    rerun()
+if PROFILING_ALLOWED and is_dev_mode:
+    render_perf_panel()
 
 df = load_memory_test()
 if df.empty:
@@ -328,7 +560,7 @@ if is_dev_mode:
         st.session_state.phase = None
         st.session_state.display_start_time = None
         st.session_state.q_start_time = None
-        st.rerun()
+        rerun()
 
 ###############################################
 # אתחול מצב
@@ -374,7 +606,7 @@ if is_dev_mode:
     if st.sidebar.button("דלג"):
         st.session_state.graph_index = jump_idx - 1
         st.session_state.stage = "context" if st.session_state.group in ["G1","G2"] else "g3_show"
-        st.rerun()
+        rerun()
 
 ###############################################
 # פונקציות זרימה
@@ -430,7 +662,7 @@ if st.session_state.stage == "welcome":
         else:
             st.session_state.phase = "show"
             st.session_state.stage = "g3_show"
-        st.rerun()
+        rerun()
 
 ###############################################
 # G1 — הקשר > גרף (מ-db) > Q1 > Q2 (עם הגרף מעל השאלה)
@@ -448,7 +680,7 @@ elif st.session_state.group == "G1":
             st.session_state.stage = "image"
             st.session_state.display_start_time = time.time()
             log_event("Show Context", {"chart": row['ChartNumber'], "graph_id": graph_id})
-            st.rerun()
+            rerun()
 
     elif st.session_state.stage == "image":
         show_group_badge()
@@ -460,7 +692,7 @@ elif st.session_state.group == "G1":
         if elapsed >= DISPLAY_TIME_GRAPH:
             st.session_state.stage = "q1"
             st.session_state.q_start_time = time.time()
-            st.rerun()
+            rerun()
         else:
             tick_and_rerun(1.0)
 
@@ -474,7 +706,7 @@ elif st.session_state.group == "G1":
         render_header(remaining, st.session_state.graph_index + 1, TOTAL_GRAPHS, "זמן לשאלה")
         render_chart_title(row)
         draw_bar_chart(sub)
-        with st.form(key=f"g1_q{qn}_{row['ChartNumber']}"):
+        with _perf.span("form"), st.form(key=f"g1_q{qn}_{row['ChartNumber']}"):
             show_rtl_text(f"גרף {row['ChartNumber']} — שאלה {qn}", "h3")
             show_rtl_text(qtxt)
             answer = st.radio("", opts, key=f"g1_a{qn}_{row['ChartNumber']}", index=None, label_visibility="collapsed",
@@ -489,7 +721,7 @@ elif st.session_state.group == "G1":
                 st.session_state.q_start_time = time.time()
             else:
                 save_and_advance_graph()
-            st.rerun()
+            rerun()
         else:
             tick_and_rerun(1.0)
 
@@ -510,7 +742,7 @@ elif st.session_state.group == "G2":
             st.session_state.stage = "g2_image"
             st.session_state.display_start_time = time.time()
             log_event("Show Context (G2)", {"chart": row['ChartNumber'], "graph_id": graph_id})
-            st.rerun()
+            rerun()
 
     elif st.session_state.stage == "g2_image":
         show_group_badge()
@@ -522,7 +754,7 @@ elif st.session_state.group == "G2":
         if elapsed >= DISPLAY_TIME_GRAPH:
             st.session_state.stage = "g2_q"
             st.session_state.q_start_time = time.time()
-            st.rerun()
+            rerun()
         else:
             tick_and_rerun(1.0)
 
@@ -535,7 +767,7 @@ elif st.session_state.group == "G2":
         remaining = max(0, int(QUESTION_MAX_TIME - elapsed))
         render_header(remaining, st.session_state.graph_index + 1, TOTAL_GRAPHS, "זמן לשאלה")
         # *** אין גרף כאן — רק טופס השאלה ***
-        with st.form(key=f"g2_q{qn}_{row['ChartNumber']}"):
+        with _perf.span("form"), st.form(key=f"g2_q{qn}_{row['ChartNumber']}"):
             show_rtl_text(f"גרף {row['ChartNumber']} — שאלה {qn}", "h3")
             show_rtl_text(qtxt)
             answer = st.radio("", opts, key=f"g2_a{qn}_{row['ChartNumber']}", index=None, label_visibility="collapsed",
@@ -551,7 +783,7 @@ elif st.session_state.group == "G2":
                 save_and_advance_graph()
             else:
                 st.session_state.q_start_time = time.time()
-            st.rerun()
+            rerun()
         else:
             tick_and_rerun(1.0)
 
@@ -577,13 +809,13 @@ elif st.session_state.group == "G3":
         if elapsed >= DISPLAY_TIME_GRAPH:
             st.session_state.stage = "g3_eval"
             st.session_state.display_start_time = None
-            st.rerun()
+            rerun()
         else:
             tick_and_rerun(1.0)
 
     elif st.session_state.stage == "g3_eval" and st.session_state.phase == "show":
         show_group_badge()
-        with st.form(key=f"g3_eval_{row['ChartNumber']}"):
+        with _perf.span("form"), st.form(key=f"g3_eval_{row['ChartNumber']}"):
             show_rtl_text("שאלת הערכה: באיזו מידה את/ה חושב/ת שתזכור/י את הנתונים בעוד כשעתיים? (1-5)", "h3")
             memory = st.slider("", 1, 5, step=1, key=f"g3_mem_{row['ChartNumber']}", label_visibility="collapsed")
             submitted = st.form_submit_button("המשך")
@@ -600,7 +832,7 @@ elif st.session_state.group == "G3":
             })
             log_event("Memory Estimate (G3)", {"chart": row['ChartNumber'], "estimate": memory})
             save_and_advance_graph()
-            st.rerun()
+            rerun()
 
     elif st.session_state.stage == "g3_questions" and st.session_state.phase == "questions":
         show_group_badge()
@@ -612,7 +844,7 @@ elif st.session_state.group == "G3":
         elapsed = time.time() - st.session_state.q_start_time
         remaining = max(0, int(QUESTION_MAX_TIME - elapsed))
         render_header(remaining, st.session_state.graph_index + 1, TOTAL_GRAPHS, "זמן לשאלה")
-        with st.form(key=f"g3_q{qn}_{row['ChartNumber']}"):
+        with _perf.span("form"), st.form(key=f"g3_q{qn}_{row['ChartNumber']}"):
             show_rtl_text(f"שאלות סופיות — גרף {row['ChartNumber']} — שאלה {qn}/3", "h3")
             show_rtl_text(qtxt)
             answer = st.radio("", opts, key=f"g3_a{qn}_{row['ChartNumber']}", index=None, label_visibility="collapsed",
@@ -633,7 +865,7 @@ elif st.session_state.group == "G3":
                     st.session_state.q_start_time = None
             else:
                 st.session_state.q_start_time = time.time()
-            st.rerun()
+            rerun()
         else:
             tick_and_rerun(1.0)
 
@@ -661,3 +893,5 @@ if st.session_state.stage == "end":
             st.sidebar.success("ברוך/ה הבא/ה, מנהל/ת!")
         elif admin_password:
             st.sidebar.error("סיסמה שגויה")
+
+_perf.finish()